@@ -1,51 +1,328 @@
+import asyncio
+import functools
+import hashlib
 import json
 import os
+import tempfile
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import PyPDF2
 import io
 import re
 
+import httpx
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import tiktoken
 from dotenv import load_dotenv
-from openpyxl.styles import Font, PatternFill
-import pytesseract
+import aiopytesseract
+from aiopytesseract.exceptions import TesseractRuntimeError, TesseractTimeoutError
 from pdf2image import convert_from_bytes
 import fitz  # pymupdf
 
+# Bump whenever the extraction prompt changes so cached results are not reused
+PROMPT_VERSION = "v2"
+
+# Upper bound on DeepSeek requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+REQUEST_TIMEOUT = 120
+
+# Transient API failures are retried with exponential backoff
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Consecutive pages are packed into one request up to 80% of the deepseek-chat
+# context window, leaving the rest for the prompt and the JSON response
+CONTEXT_TOKENS = 128000
+MAX_CHUNK_TOKENS = int(CONTEXT_TOKENS * 0.8)
+
+_PAGE_SPLIT = re.compile(r'===== Page \d+ =====')
+
+# Pages are rendered for OCR at this resolution in grayscale. That is enough
+# for invoice text and gives Tesseract far fewer pixels than 200 DPI RGB.
+OCR_DPI = 150
+# Seconds a single page may spend in Tesseract before it is given up on
+OCR_TIMEOUT = 120
+
+# Pages with fewer non-whitespace characters in their text layer are OCRed
+MIN_TEXT_LAYER_CHARS = 100
+
+
+def _ocr_concurrency():
+    """Number of Tesseract processes allowed to run at once"""
+    # Pages are OCRed by parallel Tesseract processes, so each one should stay
+    # single-threaded instead of starting an OpenMP thread per core
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    value = os.getenv("OCR_CONCURRENCY", str(os.cpu_count() or 1))
+    try:
+        concurrency = int(value)
+    except ValueError:
+        raise ValueError(f"OCR_CONCURRENCY must be a whole number, got {value!r}") from None
+    # A semaphore of 0 would block OCR forever, so run at least one process
+    return max(1, concurrency)
+
+
+async def _ocr_png(page_num, image_bytes):
+    """OCR one page image; a page that fails or times out yields empty text"""
+    try:
+        return await aiopytesseract.image_to_string(image_bytes, dpi=OCR_DPI, timeout=OCR_TIMEOUT)
+    except (TesseractTimeoutError, TesseractRuntimeError) as e:
+        print(f"OCR failed for page {page_num}: {e}")
+        return ""
+
+
+def _image_to_png_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_page_png(pdf_document, render_lock, page_num):
+    """Render a page for OCR as a grayscale PNG"""
+    with render_lock:
+        pixmap = pdf_document[page_num - 1].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+        return pixmap.tobytes("png")
+
+
+def _parse_invoice_arrays(content):
+    """Collect invoices from every JSON array in a model reply; None if there is none"""
+    # Decoding each array in place tolerates commentary, code fences and
+    # several arrays in one reply, where slicing from the first "[" to the
+    # last "]" would fail to parse and lose the whole chunk
+    decoder = json.JSONDecoder()
+    invoices = None
+    pos = content.find('[')
+    while pos != -1:
+        try:
+            array, end = decoder.raw_decode(content, pos)
+        except json.JSONDecodeError:
+            pos = content.find('[', pos + 1)
+            continue
+        if invoices is None:
+            invoices = []
+        invoices.extend(_iter_invoice_objects(array))
+        pos = content.find('[', end)
+
+    # Arrays that parsed but held no objects while the reply does contain
+    # some mean the invoices are in a shape we did not recognise; report a
+    # failure so the empty result is not cached
+    if invoices == [] and '{' in content:
+        return None
+    return invoices
+
+
+def _iter_invoice_objects(array):
+    """Yield the objects of an array, flattening nested arrays such as one list per page"""
+    for item in array:
+        if isinstance(item, dict):
+            yield item
+        elif isinstance(item, list):
+            yield from _iter_invoice_objects(item)
+
+
+@functools.lru_cache(maxsize=None)
+def _token_encoding():
+    """Load the tokenizer once; None if it is unavailable (e.g. offline on first use)"""
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Could not load tokenizer, estimating token counts instead: {e!r}")
+        return None
+
+
+def _count_tokens(text):
+    encoding = _token_encoding()
+    if encoding is None:
+        # Simple token estimation (1 token ≈ 4 characters)
+        return len(text) // 4
+    return len(encoding.encode_ordinary(text))
+
+
+def _retry_after(response):
+    """Seconds a 429/503 response asks us to wait, or None if it gives no usable Retry-After"""
+    if response.status_code not in (429, 503):
+        return None
+    value = response.headers.get("Retry-After")
+    if not isinstance(value, str):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # Retry-After may also be an HTTP date
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class _ChunkBuilder:
+    """Packs consecutive pages into chunks of at most max_tokens tokens"""
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.parts = []
+        self.tokens = 0
+
+    def add(self, page):
+        """Add a page, returning the finished chunk if the page did not fit"""
+        part = f"\n===== Page =====\n{page}"
+        part_tokens = _count_tokens(part)
+
+        chunk = None
+        if self.parts and self.tokens + part_tokens > self.max_tokens:
+            chunk = self.flush()
+        self.parts.append(part)
+        self.tokens += part_tokens
+        return chunk
+
+    def flush(self):
+        """Return the last partially filled chunk, if any"""
+        chunk = "".join(self.parts)
+        self.parts = []
+        self.tokens = 0
+        return chunk or None
+
 
 class DeepSeekInvoiceExtractor:
-    def __init__(self, api_key):
+    _SYSTEM_PROMPT = """
+        You are an expert at extracting structured data from invoices. Always return valid JSON.
+
+        The user message is a partial document which contains invoices for Oaks at Creekside.
+        Extract all invoice data and return it as a structured JSON array.
+
+        For each invoice, extract these fields:
+        - Vendor Name
+        - Invoice Number
+        - Invoice Date
+        - Due Date
+        - PO Number (if available)
+        - Total Amount
+        - Description of Services/Goods
+        - Bill To / Property Name
+        - Payment Terms
+        - Remit To / Payment Instructions
+
+        Return ONLY valid JSON in this format:
+        [
+          {
+            "Vendor Name": "Vendor Name",
+            "Invoice Number": "Number",
+            "Invoice Date": "Date",
+            "Due Date": "Date",
+            "PO Number": "Number or empty",
+            "Total Amount": "Amount",
+            "Description": "Description",
+            "Bill To": "Name",
+            "Payment Terms": "Terms",
+            "Payment Instructions": "Instructions"
+          },
+          ...
+        ]
+        """
+
+    def __init__(self, api_key, cache_dir=None):
         self.api_key = api_key
         self.api_url = "https://api.deepseek.com/v1/chat/completions"
+        self.model = "deepseek-chat"
+        # Directory for cached chunk extractions; caching is off when None
+        self.cache_dir = cache_dir
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        # Reuse connections across chunks and retry transient API failures
+        # total counts retries, so MAX_ATTEMPTS - 1 gives the same attempt budget as the async path
+        retries = Retry(total=MAX_ATTEMPTS - 1, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                        allowed_methods=frozenset({"POST"}), raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20, max_retries=retries))
 
     def extract_text_from_pdf_fitz(self, pdf_content):
         pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
-        text = ""
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            text += f"===== Page {page_num + 1} =====\n"
-            text += page.get_text() + "\n\n"
-        return text
+        parts = []
+        for page_num, page in enumerate(pdf_document.pages(), 1):
+            parts.append(f"===== Page {page_num} =====\n")
+            parts.append(page.get_text())
+            parts.append("\n\n")
+        return "".join(parts)
 
     def extract_text_from_pdf(self, pdf_content):
         """Extract text from PDF using OCR"""
         print("Converting PDF to images...")
-        images = convert_from_bytes(pdf_content)
+        # thread_count splits the page range across several pdftoppm processes
+        images = convert_from_bytes(pdf_content, dpi=OCR_DPI, grayscale=True, thread_count=os.cpu_count() or 1)
+
+        print(f"Processing {len(images)} page(s) with OCR...")
+        page_texts = asyncio.run(self._ocr_pages_async(images))
 
         text = ""
-        for i, image in enumerate(images):
-            print(f"Processing page {i + 1}/{len(images)} with OCR...")
-            page_text = pytesseract.image_to_string(image)
+        for i, page_text in enumerate(page_texts):
             text += f"===== Page {i + 1} =====\n"
             text += page_text + "\n\n"
 
         return text
 
+    async def _ocr_pages_async(self, images):
+        """OCR all page images concurrently, returning texts in page order"""
+        # Encode once up front so the gather only waits on Tesseract itself
+        images_bytes = [_image_to_png_bytes(image) for image in images]
+        sem = asyncio.Semaphore(_ocr_concurrency())
+        return await asyncio.gather(*(self._ocr_image_async(sem, page_num, image_bytes)
+                                      for page_num, image_bytes in enumerate(images_bytes, 1)))
+
+    async def aiter_pages(self, pdf_content):
+        """Yield (page_num, text) pairs in page order, OCRing only pages without a text layer"""
+        # Reading the embedded text layer is orders of magnitude cheaper than
+        # OCR, so only scanned pages are rendered and sent to Tesseract
+        pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
+        # PyMuPDF is not thread-safe: renders run one at a time in worker
+        # threads, and the document is only closed once no render is running
+        render_lock = threading.Lock()
+        try:
+            page_texts = [page.get_text() for page in pdf_document]
+
+            sem = asyncio.Semaphore(_ocr_concurrency())
+            tasks = {
+                page_num: asyncio.create_task(self._ocr_page_async(sem, render_lock, pdf_document, page_num))
+                for page_num, page_text in enumerate(page_texts, 1)
+                if len("".join(page_text.split())) < MIN_TEXT_LAYER_CHARS
+            }
+            if tasks:
+                print(f"Processing {len(tasks)}/{len(page_texts)} page(s) with OCR...")
+            try:
+                for page_num, page_text in enumerate(page_texts, 1):
+                    if page_num in tasks:
+                        page_text = await tasks[page_num]
+                    yield page_num, page_text
+            finally:
+                for task in tasks.values():
+                    task.cancel()
+        finally:
+            with render_lock:
+                pdf_document.close()
+
+    async def _ocr_page_async(self, sem, render_lock, pdf_document, page_num):
+        """Render a single page of an open PDF and OCR it"""
+        async with sem:
+            image_bytes = await asyncio.to_thread(_render_page_png, pdf_document, render_lock, page_num)
+            return await _ocr_png(page_num, image_bytes)
+
+    async def _ocr_image_async(self, sem, page_num, image_bytes):
+        """OCR a single encoded page image, bounded by the shared semaphore"""
+        async with sem:
+            return await _ocr_png(page_num, image_bytes)
+
     def extract_text_from_pdf1(self, pdf_content):
         """Extract text from PDF content"""
         pdf_file = io.BytesIO(pdf_content)
@@ -59,177 +336,227 @@ class DeepSeekInvoiceExtractor:
 
         return text
 
-    def split_text_into_chunks(self, text, max_tokens=100000):
-        """Split text into chunks based on approximate token count"""
-        # Simple token estimation (1 token ≈ 4 characters)
-        max_chars = max_tokens * 4
-
+    def split_text_into_chunks(self, text, max_tokens=MAX_CHUNK_TOKENS):
+        """Split text into chunks based on token count"""
         # Split by pages to maintain context
-        pages = re.split(r'===== Page \d+ =====', text)
+        pages = _PAGE_SPLIT.split(text)
         pages = [page for page in pages if page.strip()]
+        return list(self.iter_chunks(pages, max_tokens))
 
-        chunks = []
-        current_chunk = ""
-
+    def iter_chunks(self, pages, max_tokens=MAX_CHUNK_TOKENS):
+        """Yield chunks of consecutive pages as soon as each one is full"""
+        builder = _ChunkBuilder(max_tokens)
         for page in pages:
-            if len(current_chunk) + len(page) > max_chars:
-                chunks.append(current_chunk)
-                current_chunk = page
-            else:
-                current_chunk += f"\n===== Page =====\n{page}"
-
-        if current_chunk:
-            chunks.append(current_chunk)
-
-        return chunks
-
-    def extract_invoice_data_from_chunk(self, text_chunk):
-        """Extract invoice data from a text chunk"""
-        prompt = """
-        Analyze this partial document which contains invoices for Oaks at Creekside.
-        Extract all invoice data and return it as a structured JSON array.
-
-        For each invoice, extract these fields:
-        - Vendor Name
-        - Invoice Number
-        - Invoice Date
-        - Due Date
-        - PO Number (if available)
-        - Total Amount
-        - Description of Services/Goods
-        - Bill To / Property Name
-        - Payment Terms
-        - Remit To / Payment Instructions
-
-        Return ONLY valid JSON in this format:
-        [
-          {
-            "Vendor Name": "Vendor Name",
-            "Invoice Number": "Number",
-            "Invoice Date": "Date",
-            "Due Date": "Date",
-            "PO Number": "Number or empty",
-            "Total Amount": "Amount",
-            "Description": "Description",
-            "Bill To": "Name",
-            "Payment Terms": "Terms",
-            "Payment Instructions": "Instructions"
-          },
-          ...
-        ]
-        """
-
-        # Prepare the request payload
+            chunk = builder.add(page)
+            if chunk is not None:
+                yield chunk
+        chunk = builder.flush()
+        if chunk is not None:
+            yield chunk
+
+    def _build_payload(self, text_chunk):
+        """Build the chat completion request for a text chunk"""
+        # The system prompt comes first and never changes, so DeepSeek's prefix
+        # cache can serve it; the user message carries only the chunk
         payload = {
-            "model": "deepseek-chat",
+            "model": self.model,
             "messages": [
-                {
-                    "role": "system",
-                    "content": "You are an expert at extracting structured data from invoices. Always return valid JSON."
-                },
-                {
-                    "role": "user",
-                    "content": f"{prompt}\n\nDocument Text: {text_chunk}"
-                }
+                {"role": "system", "content": self._SYSTEM_PROMPT},
+                {"role": "user", "content": text_chunk}
             ],
             "temperature": 0.1
         }
+        return payload
 
-        # Make the API request
-        response = requests.post(self.api_url, headers=self.headers, json=payload)
-
+    def _parse_response(self, response):
+        """Parse the invoice list out of an API response"""
         if response.status_code == 200:
-            response_data = response.json()
-            content = response_data['choices'][0]['message']['content']
-
-            # Extract JSON from the response
             try:
-                # Find JSON start and end positions
-                json_start = content.find('[')
-                json_end = content.rfind(']') + 1
-
-                if json_start == -1 or json_end == 0:
-                    return []
-
-                json_str = content[json_start:json_end]
-
-                # Parse the JSON
-                invoice_data = json.loads(json_str)
-                return invoice_data
-            except (json.JSONDecodeError, ValueError) as e:
-                print(f"Error parsing JSON: {e}")
+                response_data = response.json()
+                content = response_data['choices'][0]['message']['content']
+                if not isinstance(content, str):
+                    raise TypeError(f"message content is {type(content).__name__}, not str")
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                # A malformed body only fails this chunk, never the whole batch
+                print(f"Unexpected API response: {e!r}")
+                print(f"Response: {response.text}")
+                return None
+
+            invoice_data = _parse_invoice_arrays(content)
+            if invoice_data is None:
+                print("Error parsing JSON: no JSON array found in the response")
                 print(f"Response content: {content}")
-                return []
+            return invoice_data
         else:
             print(f"API request failed with status code: {response.status_code}")
             print(f"Response: {response.text}")
+            return None
+
+    def _cache_path(self, text_chunk):
+        key = hashlib.sha256(f"deepseek|{self.model}|{PROMPT_VERSION}|{text_chunk}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _load_cached(self, text_chunk):
+        """Return the cached extraction for a chunk, or None on a miss"""
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(text_chunk), encoding="utf-8") as f:
+                return json.load(f)["invoices"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _store_cached(self, text_chunk, invoice_data):
+        if not self.cache_dir:
+            return
+        entry = {"invoices": invoice_data, "ts": datetime.now(timezone.utc).isoformat()}
+        tmp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._cache_path(text_chunk))
+        except OSError as e:
+            # A failed cache write must not lose an extraction that was already paid for
+            print(f"Could not write cache entry: {e!r}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def extract_invoice_data_from_chunk(self, text_chunk):
+        """Extract invoice data from a text chunk"""
+        cached = self._load_cached(text_chunk)
+        if cached is not None:
+            return cached
+
+        response = self.session.post(self.api_url, headers=self.headers,
+                                     json=self._build_payload(text_chunk), timeout=REQUEST_TIMEOUT)
+        invoice_data = self._parse_response(response)
+        if invoice_data is None:
             return []
+        self._store_cached(text_chunk, invoice_data)
+        return invoice_data
+
+    async def _extract_chunk_async(self, client, sem, text_chunk):
+        """Extract invoice data from a text chunk without blocking other requests"""
+        cached = self._load_cached(text_chunk)
+        if cached is not None:
+            return cached
+
+        async with sem:
+            try:
+                response = await self._post_with_retries(client, self._build_payload(text_chunk))
+            except httpx.HTTPError as e:
+                print(f"API request failed: {e!r}")
+                return []
+        invoice_data = self._parse_response(response)
+        if invoice_data is None:
+            return []
+        self._store_cached(text_chunk, invoice_data)
+        return invoice_data
+
+    async def _post_with_retries(self, client, payload):
+        """POST a request, retrying rate limits, server errors and transport failures"""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                response = await client.post(self.api_url, headers=self.headers, json=payload,
+                                             timeout=REQUEST_TIMEOUT)
+            except httpx.TransportError:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS:
+                    return response
+                # Honour the server's Retry-After, as urllib3 does on the sync path
+                delay = _retry_after(response)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    async def _run_pipeline(self, pdf_content, max_tokens=MAX_CHUNK_TOKENS):
+        """OCR the PDF and send each chunk to DeepSeek as soon as its pages are ready"""
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS)
+        async with httpx.AsyncClient(http2=True, limits=limits) as client:
+            tasks = []
+
+            def submit(chunk):
+                print(f"Processing chunk {len(tasks) + 1}...")
+                tasks.append(asyncio.create_task(self._extract_chunk_async(client, sem, chunk)))
+
+            try:
+                builder = _ChunkBuilder(max_tokens)
+                async for _, page_text in self.aiter_pages(pdf_content):
+                    if not page_text.strip():
+                        continue
+                    chunk = builder.add(page_text)
+                    if chunk is not None:
+                        submit(chunk)
+                chunk = builder.flush()
+                if chunk is not None:
+                    submit(chunk)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+            # gather returns results in submission order, i.e. chunk order
+            return await asyncio.gather(*tasks)
 
     def export_to_excel(self, invoice_data, filename="invoice_data.xlsx"):
         # Create a DataFrame from the invoice data
         df = pd.DataFrame(invoice_data)
 
         # Create Excel writer
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+        with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
             df.to_excel(writer, sheet_name='Invoices', index=False)
 
             # Get workbook and worksheet
             workbook = writer.book
             worksheet = writer.sheets['Invoices']
 
-            # Apply formatting
-            header_fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-            header_font = Font(bold=True)
-
             # Format headers
-            for cell in worksheet[1]:
-                cell.fill = header_fill
-                cell.font = header_font
-
-            # Adjust column widths
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+            header_format = workbook.add_format({'bold': True, 'bg_color': '#D3D3D3'})
+            for i, column in enumerate(df.columns):
+                worksheet.write(0, i, column, header_format)
+
+            # Adjust column widths, measured on the DataFrame in one pass
+            # rather than by visiting every written cell
+            value_lengths = df.astype(str).apply(lambda column: column.str.len().max()).fillna(0).to_numpy()
+            header_lengths = [len(str(column)) for column in df.columns]
+            widths = np.minimum(np.maximum(value_lengths, header_lengths) + 2, 50)
+            for i, width in enumerate(widths):
+                worksheet.set_column(i, i, int(width))
 
         print(f"Invoice data exported to {filename}")
 
     def extract_invoice_data(self, pdf_content):
         """Main method to extract invoice data from PDF"""
-        # Extract text from PDF
-        text = self.extract_text_from_pdf(pdf_content)
-
-        # Split text into chunks
-        chunks = self.split_text_into_chunks(text)
-
-        # Process each chunk
+        # OCR, chunking and the API calls are pipelined: each chunk is sent
+        # as soon as its pages are OCRed, while later pages are still running
         all_invoices = []
-        for i, chunk in enumerate(chunks):
-            print(f"Processing chunk {i + 1}/{len(chunks)}...")
-            chunk_invoices = self.extract_invoice_data_from_chunk(chunk)
+        for chunk_invoices in asyncio.run(self._run_pipeline(pdf_content)):
             all_invoices.extend(chunk_invoices)
 
-        # Remove duplicates based on invoice number
-        unique_invoices = {}
+        # Remove duplicates based on vendor and invoice number, keeping the first seen
+        seen = set()
+        unique_invoices = []
         for invoice in all_invoices:
-            invoice_id = f"{invoice.get('Vendor Name', '')}-{invoice.get('Invoice Number', '')}"
-            if invoice_id not in unique_invoices:
-                unique_invoices[invoice_id] = invoice
+            # str() keeps the key hashable when the model returns a list or object for a field
+            invoice_id = (str(invoice.get('Vendor Name', '')), str(invoice.get('Invoice Number', '')))
+            if invoice_id not in seen:
+                seen.add(invoice_id)
+                unique_invoices.append(invoice)
 
-        return list(unique_invoices.values())
+        return unique_invoices
 
 
 if __name__ == "__main__":
     load_dotenv()
     api_key = os.getenv('DEEPSEEK_API_KEY')
-    extractor = DeepSeekInvoiceExtractor(api_key)
+    extractor = DeepSeekInvoiceExtractor(api_key, cache_dir=os.getenv('INVOICE_CACHE_DIR', '.invoice_cache'))
 
     pdf_path = "invoices_example.pdf"
     with open(pdf_path, "rb") as file:
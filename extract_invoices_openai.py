@@ -9,6 +9,8 @@ from dotenv import load_dotenv
 # Load environment variables (for API key)
 load_dotenv()
 
+_WHITESPACE = re.compile(r'\s+')
+
 
 class InvoiceExtractor:
     def __init__(self):
@@ -29,19 +31,22 @@ class InvoiceExtractor:
         """
 
     def extract_text_from_pdf(self, pdf_path):
-        """Extract text from PDF using pdfplumber"""
-        full_text = ""
+        """Extract whitespace-normalised text from PDF using pdfplumber"""
+        parts = []
         with pdfplumber.open(pdf_path) as pdf:
             for page in pdf.pages:
-                page_text = page.extract_text()
+                # Normalise whitespace per page instead of in a second pass over the whole text
+                page_text = self.clean_text(page.extract_text() or '')
                 if page_text:
-                    full_text += page_text + "\n"
-        return full_text
+                    parts.append(page_text)
+                # Release the page's parsed objects so memory stays flat on long documents
+                page.close()
+        return " ".join(parts)
 
     def clean_text(self, text):
         """Basic text cleaning"""
         # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
+        text = _WHITESPACE.sub(' ', text)
         return text.strip()
 
     def extract_invoice_data_with_llm(self, text):
@@ -67,15 +72,12 @@ class InvoiceExtractor:
         """Process a PDF file and extract invoice data"""
         print(f"Processing {pdf_path}...")
 
-        # Extract text from PDF
-        raw_text = self.extract_text_from_pdf(pdf_path)
-        if not raw_text:
+        # Extract text from PDF, already cleaned page by page
+        cleaned_text = self.extract_text_from_pdf(pdf_path)
+        if not cleaned_text:
             print(f"Could not extract text from {pdf_path}")
             return None
 
-        # Clean text
-        cleaned_text = self.clean_text(raw_text)
-
         # Use LLM to extract structured data
         invoice_data = self.extract_invoice_data_with_llm(cleaned_text)
 
@@ -1,8 +1,13 @@
+import asyncio
 import json
 
+import fitz
+import openpyxl
+import pandas as pd
 import pytest
-from unittest.mock import patch, MagicMock
-from extract_invoices_deepseek import DeepSeekInvoiceExtractor
+from aiopytesseract.exceptions import TesseractTimeoutError
+from unittest.mock import patch, MagicMock, AsyncMock
+from extract_invoices_deepseek import MAX_ATTEMPTS, DeepSeekInvoiceExtractor, _ocr_concurrency
 
 # Mock sample PDF text
 SAMPLE_PDF_TEXT = """
@@ -34,11 +39,51 @@ def extractor():
 
 def test_extract_text_from_pdf(extractor):
     """Test OCR-based PDF text extraction."""
-    with patch("extract_invoices_deepseek.convert_from_bytes", return_value=[MagicMock()]):
-        with patch("extract_invoices_deepseek.pytesseract.image_to_string", return_value="Invoice Number: INV12345"):
+    with patch("extract_invoices_deepseek.convert_from_bytes", return_value=[MagicMock()]) as mock_convert:
+        with patch("extract_invoices_deepseek.aiopytesseract.image_to_string",
+                   new=AsyncMock(return_value="Invoice Number: INV12345")):
             result = extractor.extract_text_from_pdf(b"mock_pdf_content")
             assert "===== Page 1 =====" in result
             assert "Invoice Number: INV12345" in result
+            assert mock_convert.call_args.kwargs["thread_count"] >= 1
+
+def test_extract_text_from_pdf_multiple_pages(extractor):
+    """Test that pages are OCRed concurrently and reassembled in page order."""
+    async def fake_ocr(image_bytes, **kwargs):
+        # Finish the first page last to make sure ordering does not depend on completion
+        await asyncio.sleep(0.01 if image_bytes == b"page1" else 0)
+        return {b"page1": "Invoice Number: INV12345", b"page2": "Vendor Name: Example Vendor"}[image_bytes]
+
+    with patch("extract_invoices_deepseek.convert_from_bytes", return_value=[MagicMock(), MagicMock()]):
+        with patch("extract_invoices_deepseek._image_to_png_bytes", side_effect=[b"page1", b"page2"]):
+            with patch("extract_invoices_deepseek.aiopytesseract.image_to_string", new=fake_ocr):
+                result = extractor.extract_text_from_pdf(b"mock_pdf_content")
+                assert result.index("===== Page 1 =====") < result.index("INV12345")
+                assert result.index("===== Page 2 =====") < result.index("Example Vendor")
+
+def test_extract_text_from_pdf_page_ocr_failure(extractor):
+    """Test that a page whose OCR fails or times out does not abort the other pages."""
+    async def fake_ocr(image_bytes, **kwargs):
+        if image_bytes == b"page1":
+            raise TesseractTimeoutError(kwargs["timeout"])
+        return "Vendor Name: Example Vendor"
+
+    with patch("extract_invoices_deepseek.convert_from_bytes", return_value=[MagicMock(), MagicMock()]):
+        with patch("extract_invoices_deepseek._image_to_png_bytes", side_effect=[b"page1", b"page2"]):
+            with patch("extract_invoices_deepseek.aiopytesseract.image_to_string", new=fake_ocr):
+                result = extractor.extract_text_from_pdf(b"mock_pdf_content")
+                assert "===== Page 1 =====" in result
+                assert "Vendor Name: Example Vendor" in result
+
+def test_ocr_concurrency_is_at_least_one():
+    """Test that OCR_CONCURRENCY values below one still allow OCR to run."""
+    with patch.dict("os.environ", {"OCR_CONCURRENCY": "0"}):
+        assert _ocr_concurrency() == 1
+    with patch.dict("os.environ", {"OCR_CONCURRENCY": "4"}):
+        assert _ocr_concurrency() == 4
+    with patch.dict("os.environ", {"OCR_CONCURRENCY": "many"}):
+        with pytest.raises(ValueError, match="OCR_CONCURRENCY"):
+            _ocr_concurrency()
 
 def test_extract_text_from_pdf1(extractor):
     """Test PyPDF2-based PDF text extraction."""
@@ -58,8 +103,7 @@ def test_extract_text_from_pdf_fitz(extractor):
     mock_pdf_document = MagicMock()
     mock_page = MagicMock()
     mock_page.get_text.return_value = "Invoice Number: INV12345"
-    mock_pdf_document.load_page.return_value = mock_page
-    mock_pdf_document.__len__.return_value = 1
+    mock_pdf_document.pages.return_value = iter([mock_page])
     
     with patch("extract_invoices_deepseek.fitz.open", return_value=mock_pdf_document):
         result = extractor.extract_text_from_pdf_fitz(b"mock_pdf_content")
@@ -79,9 +123,21 @@ def test_split_text_into_chunks(extractor):
     assert "Invoice Number: INV12345" in chunks[0]
     assert "Vendor Name: Example Vendor" in chunks[1]
 
+def test_split_text_into_chunks_counts_tokens(extractor):
+    """Test that pages are packed into chunks by tokenizer token count."""
+    encoding = MagicMock()
+    encoding.encode_ordinary.side_effect = str.split  # one token per word
+    text = "===== Page 1 =====\none two\n===== Page 2 =====\nthree\n===== Page 3 =====\nfour five six"
+    with patch("extract_invoices_deepseek._token_encoding", return_value=encoding):
+        chunks = extractor.split_text_into_chunks(text, max_tokens=12)
+    # Each page costs its words plus 3 for the "===== Page =====" separator
+    assert len(chunks) == 2
+    assert "two" in chunks[0] and "three" in chunks[0]
+    assert "four five six" in chunks[1]
+
 def test_extract_invoice_data_from_chunk(extractor):
     """Test invoice data extraction from a text chunk."""
-    with patch("extract_invoices_deepseek.requests.post") as mock_post:
+    with patch.object(extractor.session, "post") as mock_post:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -95,9 +151,17 @@ def test_extract_invoice_data_from_chunk(extractor):
         assert result[0]["Invoice Number"] == "INV12345"
         assert result[0]["Vendor Name"] == "Example Vendor"
 
+def test_session_retries_post_requests(extractor):
+    """Test that API requests share a pooled session that retries transient failures."""
+    retries = extractor.session.get_adapter(extractor.api_url).max_retries
+    # total counts retries, so the sync path makes MAX_ATTEMPTS attempts like the async one
+    assert retries.total == MAX_ATTEMPTS - 1
+    assert "POST" in retries.allowed_methods
+    assert 429 in retries.status_forcelist
+
 def test_extract_invoice_data_from_chunk_error(extractor):
     """Test handling of API error in chunk processing."""
-    with patch("extract_invoices_deepseek.requests.post") as mock_post:
+    with patch.object(extractor.session, "post") as mock_post:
         mock_response = MagicMock()
         mock_response.status_code = 400
         mock_response.text = "Bad Request"
@@ -108,7 +172,7 @@ def test_extract_invoice_data_from_chunk_error(extractor):
 
 def test_extract_invoice_data_from_chunk_invalid_json(extractor):
     """Test handling of invalid JSON in chunk processing."""
-    with patch("extract_invoices_deepseek.requests.post") as mock_post:
+    with patch.object(extractor.session, "post") as mock_post:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -119,22 +183,239 @@ def test_extract_invoice_data_from_chunk_invalid_json(extractor):
         result = extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT)
         assert result == []
 
+def test_extract_invoice_data_from_chunk_mixed_content(extractor):
+    """Test that invoices are recovered from several arrays mixed with commentary."""
+    second_invoice = dict(SAMPLE_EXTRACTED_DATA[0], **{"Invoice Number": "INV67890"})
+    third_invoice = dict(SAMPLE_EXTRACTED_DATA[0], **{"Invoice Number": "INV24680"})
+    content = (f"Here are the invoices [page 1]:\n```json\n{json.dumps(SAMPLE_EXTRACTED_DATA)}\n```\n"
+               f"and one more:\n{json.dumps([second_invoice])}\n"
+               f"grouped by page:\n{json.dumps([[third_invoice]])}")
+    with patch.object(extractor.session, "post") as mock_post:
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"choices": [{"message": {"content": content}}]}
+        mock_post.return_value = mock_response
+
+        result = extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT)
+        assert [invoice["Invoice Number"] for invoice in result] == ["INV12345", "INV67890", "INV24680"]
+
+def test_extract_invoice_data_from_chunk_unrecognised_shape_not_cached(tmp_path):
+    """Test that a reply whose arrays hold no invoice objects is not cached as empty."""
+    extractor = DeepSeekInvoiceExtractor(api_key="mock_api_key", cache_dir=str(tmp_path))
+    with patch.object(extractor.session, "post") as mock_post:
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "choices": [{"message": {"content": '["INV12345"] {"Invoice Number": "INV12345"'}}]
+        }
+        mock_post.return_value = mock_response
+
+        assert extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT) == []
+        assert list(tmp_path.iterdir()) == []
+
+def test_extract_invoice_data_from_chunk_cached(tmp_path):
+    """Test that a repeated chunk is served from the cache without another API call."""
+    extractor = DeepSeekInvoiceExtractor(api_key="mock_api_key", cache_dir=str(tmp_path))
+    with patch.object(extractor.session, "post") as mock_post:
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "choices": [{"message": {"content": json.dumps(SAMPLE_EXTRACTED_DATA)}}]
+        }
+        mock_post.return_value = mock_response
+
+        assert extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT) == SAMPLE_EXTRACTED_DATA
+        assert extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT) == SAMPLE_EXTRACTED_DATA
+        assert mock_post.call_count == 1
+
+def test_extract_invoice_data_from_chunk_cache_write_error(tmp_path):
+    """Test that a failing cache write does not lose the extracted invoices."""
+    extractor = DeepSeekInvoiceExtractor(api_key="mock_api_key", cache_dir=str(tmp_path))
+    with patch.object(extractor.session, "post") as mock_post:
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "choices": [{"message": {"content": json.dumps(SAMPLE_EXTRACTED_DATA)}}]
+        }
+        mock_post.return_value = mock_response
+
+        with patch("extract_invoices_deepseek.os.replace", side_effect=PermissionError("read-only")):
+            assert extractor.extract_invoice_data_from_chunk(SAMPLE_PDF_TEXT) == SAMPLE_EXTRACTED_DATA
+        assert list(tmp_path.iterdir()) == []  # temporary file cleaned up
+
+def test_extract_chunk_async(extractor):
+    """Test async invoice data extraction from a text chunk."""
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {
+        "choices": [{"message": {"content": json.dumps(SAMPLE_EXTRACTED_DATA)}}]
+    }
+    mock_client = MagicMock()
+    mock_client.post = AsyncMock(return_value=mock_response)
+
+    result = asyncio.run(extractor._extract_chunk_async(mock_client, asyncio.Semaphore(1), SAMPLE_PDF_TEXT))
+    assert result == SAMPLE_EXTRACTED_DATA
+    payload = mock_client.post.await_args.kwargs["json"]
+    assert payload["model"] == "deepseek-chat"
+    # Stable system prompt first, only the chunk text in the user message
+    assert payload["messages"] == [
+        {"role": "system", "content": DeepSeekInvoiceExtractor._SYSTEM_PROMPT},
+        {"role": "user", "content": SAMPLE_PDF_TEXT},
+    ]
+
+def test_aiter_pages_ocrs_only_scanned_pages(extractor):
+    """Test that pages with a text layer skip OCR while scanned pages are OCRed."""
+    pdf_document = fitz.open()
+    pdf_document.new_page().insert_text((72, 72), "\n".join(["Invoice Number: INV12345"] * 10))
+    pdf_document.new_page()  # no text layer, as for a scanned page
+    pdf_content = pdf_document.tobytes()
+
+    async def collect():
+        return [page async for page in extractor.aiter_pages(pdf_content)]
+
+    with patch("extract_invoices_deepseek.convert_from_bytes") as mock_convert:
+        with patch("extract_invoices_deepseek.aiopytesseract.image_to_string",
+                   new=AsyncMock(return_value="Vendor Name: Example Vendor")) as mock_ocr:
+            pages = asyncio.run(collect())
+
+    assert [page_num for page_num, _ in pages] == [1, 2]
+    assert "Invoice Number: INV12345" in pages[0][1]
+    assert pages[1][1] == "Vendor Name: Example Vendor"
+    # Only the scanned page is OCRed, rendered from the open document as a PNG
+    assert mock_ocr.await_count == 1
+    assert mock_ocr.await_args.args[0].startswith(b"\x89PNG")
+    assert not mock_convert.called
+
+async def _fake_pages(*page_texts):
+    for page_num, page_text in enumerate(page_texts, 1):
+        yield page_num, page_text
+
+@pytest.mark.parametrize("body", [
+    ValueError("Expecting value"),          # body is not JSON
+    {"error": "overloaded"},                # no choices
+    {"choices": [{"message": {"content": None}}]},
+])
+def test_extract_chunk_async_malformed_response(extractor, body):
+    """Test that a malformed 200 response yields no invoices instead of raising."""
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    if isinstance(body, Exception):
+        mock_response.json.side_effect = body
+    else:
+        mock_response.json.return_value = body
+    mock_client = MagicMock()
+    mock_client.post = AsyncMock(return_value=mock_response)
+
+    result = asyncio.run(extractor._extract_chunk_async(mock_client, asyncio.Semaphore(1), SAMPLE_PDF_TEXT))
+    assert result == []
+
+def test_extract_chunk_async_retries_rate_limit(extractor):
+    """Test that a rate-limited request is retried and its invoices returned."""
+    rate_limited = MagicMock()
+    rate_limited.status_code = 429
+    rate_limited.headers = {}
+    ok = MagicMock()
+    ok.status_code = 200
+    ok.json.return_value = {
+        "choices": [{"message": {"content": json.dumps(SAMPLE_EXTRACTED_DATA)}}]
+    }
+    mock_client = MagicMock()
+    mock_client.post = AsyncMock(side_effect=[rate_limited, ok])
+
+    with patch("extract_invoices_deepseek.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        result = asyncio.run(extractor._extract_chunk_async(mock_client, asyncio.Semaphore(1), SAMPLE_PDF_TEXT))
+    assert result == SAMPLE_EXTRACTED_DATA
+    assert mock_client.post.await_count == 2
+    assert mock_sleep.await_count == 1
+
+def test_extract_chunk_async_honours_retry_after(extractor):
+    """Test that a 429 waits for the server's Retry-After instead of the backoff."""
+    rate_limited = MagicMock()
+    rate_limited.status_code = 429
+    rate_limited.headers = {"Retry-After": "7"}
+    ok = MagicMock()
+    ok.status_code = 200
+    ok.json.return_value = {
+        "choices": [{"message": {"content": json.dumps(SAMPLE_EXTRACTED_DATA)}}]
+    }
+    mock_client = MagicMock()
+    mock_client.post = AsyncMock(side_effect=[rate_limited, ok])
+
+    with patch("extract_invoices_deepseek.asyncio.sleep", new=AsyncMock()) as mock_sleep:
+        result = asyncio.run(extractor._extract_chunk_async(mock_client, asyncio.Semaphore(1), SAMPLE_PDF_TEXT))
+    assert result == SAMPLE_EXTRACTED_DATA
+    mock_sleep.assert_awaited_once_with(7.0)
+
 def test_extract_invoice_data(extractor):
     """Test the main invoice data extraction pipeline."""
-    with patch.object(extractor, "extract_text_from_pdf", return_value=SAMPLE_PDF_TEXT):
-        with patch.object(extractor, "split_text_into_chunks", return_value=[SAMPLE_PDF_TEXT]):
-            with patch.object(extractor, "extract_invoice_data_from_chunk", return_value=SAMPLE_EXTRACTED_DATA):
-                result = extractor.extract_invoice_data(b"mock_pdf_content")
-                assert len(result) == 1
-                assert result[0]["Invoice Number"] == "INV12345"
-                assert result[0]["Vendor Name"] == "Example Vendor"
+    with patch.object(extractor, "aiter_pages", return_value=_fake_pages(SAMPLE_PDF_TEXT)):
+        with patch.object(extractor, "_extract_chunk_async", new=AsyncMock(return_value=SAMPLE_EXTRACTED_DATA)):
+            result = extractor.extract_invoice_data(b"mock_pdf_content")
+            assert len(result) == 1
+            assert result[0]["Invoice Number"] == "INV12345"
+            assert result[0]["Vendor Name"] == "Example Vendor"
+
+def test_extract_invoice_data_streams_chunks(extractor):
+    """Test that a full chunk is sent before the remaining pages are OCRed."""
+    events = []
+
+    async def pages():
+        for page_num, page_text in enumerate(["Invoice Number: INV12345", "Vendor Name: Example Vendor",
+                                              "Total Amount: $1000.00"], 1):
+            events.append(f"page {page_num}")
+            yield page_num, page_text
+            await asyncio.sleep(0)
+
+    async def extract_chunk(client, sem, chunk):
+        events.append("chunk")
+        return []
+
+    with patch.object(extractor, "aiter_pages", return_value=pages()):
+        with patch.object(extractor, "_extract_chunk_async", side_effect=extract_chunk):
+            asyncio.run(extractor._run_pipeline(b"mock_pdf_content", max_tokens=10))
+    # The first chunk is complete once page 2 arrives and must not wait for page 3
+    assert events.index("chunk") < events.index("page 3")
+    assert events.count("chunk") == 3
+
+def test_extract_invoice_data_keeps_repeated_pages(extractor):
+    """Test that pages shared word for word by several invoices are sent with each of them."""
+    terms = "Terms: payment due within 30 days"
+    mock_extract = AsyncMock(return_value=[])
+    with patch.object(extractor, "aiter_pages", return_value=_fake_pages(SAMPLE_PDF_TEXT, terms, SAMPLE_PDF_TEXT, terms)):
+        with patch.object(extractor, "_extract_chunk_async", new=mock_extract):
+            extractor.extract_invoice_data(b"mock_pdf_content")
+    chunk = mock_extract.await_args.args[2]
+    assert chunk.count("Terms: payment due") == 2
 
 def test_extract_invoice_data_duplicate_handling(extractor):
     """Test duplicate invoice removal."""
     duplicate_data = SAMPLE_EXTRACTED_DATA + SAMPLE_EXTRACTED_DATA
-    with patch.object(extractor, "extract_text_from_pdf", return_value=SAMPLE_PDF_TEXT):
-        with patch.object(extractor, "split_text_into_chunks", return_value=[SAMPLE_PDF_TEXT]):
-            with patch.object(extractor, "extract_invoice_data_from_chunk", return_value=duplicate_data):
-                result = extractor.extract_invoice_data(b"mock_pdf_content")
-                assert len(result) == 1  # Duplicates removed
-                assert result[0]["Invoice Number"] == "INV12345"
+    with patch.object(extractor, "aiter_pages", return_value=_fake_pages(SAMPLE_PDF_TEXT)):
+        with patch.object(extractor, "_extract_chunk_async", new=AsyncMock(return_value=duplicate_data)):
+            result = extractor.extract_invoice_data(b"mock_pdf_content")
+            assert len(result) == 1  # Duplicates removed
+            assert result[0]["Invoice Number"] == "INV12345"
+
+def test_export_to_excel(extractor, tmp_path):
+    """Test Excel export and column width sizing."""
+    filename = tmp_path / "invoices.xlsx"
+    invoices = SAMPLE_EXTRACTED_DATA + [{"Vendor Name": "V", "Description": "x" * 80}]
+    extractor.export_to_excel(invoices, filename)
+
+    df = pd.read_excel(filename, sheet_name="Invoices")
+    assert df["Invoice Number"].iloc[0] == "INV12345"
+
+    worksheet = openpyxl.load_workbook(filename)["Invoices"]
+    assert worksheet["A1"].font.bold
+    # Stored widths include a fractional padding added by the writer
+    assert int(worksheet.column_dimensions["A"].width) == len("Example Vendor") + 2
+    assert int(worksheet.column_dimensions["C"].width) == len("Invoice Date") + 2
+    assert int(worksheet.column_dimensions["G"].width) == 50  # capped
+
+def test_extract_invoice_data_duplicate_handling_malformed_fields(extractor):
+    """Test duplicate removal when the model returns a list for a key field."""
+    malformed = dict(SAMPLE_EXTRACTED_DATA[0], **{"Invoice Number": ["INV1", "INV2"]})
+    with patch.object(extractor, "aiter_pages", return_value=_fake_pages(SAMPLE_PDF_TEXT)):
+        with patch.object(extractor, "_extract_chunk_async", new=AsyncMock(return_value=[malformed, malformed])):
+            result = extractor.extract_invoice_data(b"mock_pdf_content")
+            assert result == [malformed]